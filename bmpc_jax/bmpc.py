@@ -10,7 +10,6 @@ import numpy as np
 import optax
 from flax import struct
 from jaxtyping import PRNGKeyArray, PyTree
-from tensorflow_probability.substrates.jax import distributions as tfd
 
 from bmpc_jax.common.loss import soft_crossentropy
 from bmpc_jax.common.scale import percentile_normalization
@@ -140,11 +139,19 @@ class BMPC(struct.PyTreeNode):
         )
     )
 
+    # Buffered key pool: split every key the plan consumes in one batched
+    # split instead of chaining key, subkey = split(key) at each use
+    keys = jax.random.split(key, horizon + self.mppi_iterations + 3)
+    prior_noise_keys = keys[:horizon]
+    mppi_noise_key = keys[horizon]
+    value_keys = keys[horizon+1:horizon+1+self.mppi_iterations]
+    final_action_key = keys[-2]
+    final_noise_key = keys[-1]
+
     ###########################################################
     # Policy prior samples
     ###########################################################
     if self.policy_prior_samples > 0:
-      key, *prior_noise_keys = jax.random.split(key, 1+horizon)
       policy_actions = jnp.zeros(
           (
               *batch_shape,
@@ -166,7 +173,7 @@ class BMPC(struct.PyTreeNode):
           z_t = self.model.next(
               z=z_t,
               a=policy_actions[..., t, :],
-              params=self.model.dynamics_model.params
+              params=self.model.heads.params['dynamics']
           )
 
       actions = actions.at[..., :self.policy_prior_samples, :, :].set(
@@ -177,9 +184,6 @@ class BMPC(struct.PyTreeNode):
     # MPPI planning
     ###########################################################
     z_t = z[..., None, :].repeat(self.population_size, axis=-2)
-    key, mppi_noise_key, *value_keys = jax.random.split(
-        key, 2+self.mppi_iterations
-    )
     noise = jax.random.normal(
         mppi_noise_key,
         shape=(
@@ -227,7 +231,6 @@ class BMPC(struct.PyTreeNode):
     if deterministic:  # Use best trajectory
       action_ind = jnp.argmax(elite_values, axis=-1)
     else:  # Sample from elites
-      key, final_action_key = jax.random.split(key)
       action_ind = jax.random.categorical(
           final_action_key, logits=jnp.log(score), shape=batch_shape
       )
@@ -235,7 +238,6 @@ class BMPC(struct.PyTreeNode):
         elite_actions, action_ind[..., None, None, None], axis=-3
     ).squeeze(-3)
     if train:
-      key, final_noise_key = jax.random.split(key)
       final_action = action[..., 0, :] + std[..., 0, :] * \
           jax.random.normal(
               final_noise_key, shape=batch_shape + (self.model.action_dim,)
@@ -247,33 +249,40 @@ class BMPC(struct.PyTreeNode):
 
     return final_action.clip(-1, 1), (mean, std, expert_mean, expert_std)
 
-  @partial(jax.jit, static_argnames=('horizon'))
+  @partial(jax.jit, static_argnames=('horizon',))
   def estimate_value(self,
                      z: jax.Array,
                      actions: jax.Array,
                      horizon: int,
                      key: PRNGKeyArray
                      ) -> jax.Array:
-    G, discount = 0.0, 1.0
-    for t in range(horizon):
-      reward, _ = self.model.reward(
-          z, actions[..., t, :], self.model.reward_model.params
-      )
-      z = self.model.next(
-          z, actions[..., t, :], self.model.dynamics_model.params
+    def rollout_step(carry, a_t):
+      z, G, discount = carry
+      z, reward, _, continue_logits = self.model.step(
+          z=z,
+          a=a_t,
+          dynamics_params=self.model.heads.params['dynamics'],
+          reward_params=self.model.heads.params['reward'],
       )
-      G += discount * reward
-      discount *= self.discount
+      G = G + discount * reward
+      discount = discount * self.discount
 
       if self.model.predict_continues:
-        continues = jax.nn.sigmoid(
-            self.model.continue_model.apply_fn(
-                {'params': self.model.continue_model.params}, z
-            )
-        ).squeeze(-1) > 0.5
-        discount *= continues
+        continues = jax.nn.sigmoid(continue_logits).squeeze(-1) > 0.5
+        discount = discount * continues
+
+      return (z, G, discount), None
+
+    # Scan over the horizon with partial unrolling so XLA can overlap
+    # consecutive transition steps
+    (z, G, discount), _ = jax.lax.scan(
+        rollout_step,
+        init=(z, jnp.zeros(z.shape[:-1]), jnp.ones(z.shape[:-1])),
+        xs=jnp.moveaxis(actions, -2, 0),
+        unroll=2,
+    )
 
-    Vs, _ = self.model.V(z, self.model.value_model.params, key=key)
+    Vs, _ = self.model.V(z, self.model.heads.params['value'], key=key)
     V = Vs.mean(axis=0)
     return G + discount * V
 
@@ -290,10 +299,7 @@ class BMPC(struct.PyTreeNode):
                          ) -> Tuple[BMPC, Dict[str, Any]]:
 
     def world_model_loss_fn(encoder_params: flax.core.FrozenDict,
-                            dynamics_params: flax.core.FrozenDict,
-                            value_params: flax.core.FrozenDict,
-                            reward_params: flax.core.FrozenDict,
-                            continue_params: flax.core.FrozenDict,
+                            head_params: flax.core.FrozenDict,
                             ) -> Tuple[jax.Array, Dict[str, Any]]:
       encoder_key, value_key = jax.random.split(key, 2)
       lam = self.rho**jnp.arange(self.horizon)
@@ -322,8 +328,11 @@ class BMPC(struct.PyTreeNode):
       )
       latent_zs = latent_zs.at[0].set(encoder_zs[0])
       consistency_loss = 0
+      # Rematerialize dynamics activations in the backward pass so the
+      # stored residuals stay O(1) in the rollout horizon
+      dynamics_step = jax.checkpoint(self.model.next)
       for t in range(self.horizon):
-        z = self.model.next(latent_zs[t], actions[t], dynamics_params)
+        z = dynamics_step(latent_zs[t], actions[t], head_params['dynamics'])
         consistency_loss += lam[t] * \
             jnp.mean((z - sg(next_zs[t]))**2, where=~finished[t][:, None])
         if t < self.horizon-1:
@@ -333,7 +342,9 @@ class BMPC(struct.PyTreeNode):
       ###########################################################
       # Reward loss
       ###########################################################
-      _, reward_logits = self.model.reward(latent_zs, actions, reward_params)
+      _, reward_logits, continue_logits = self.model.reward(
+          latent_zs, actions, head_params['reward']
+      )
       reward_loss = jnp.sum(
           lam[:, None] * soft_crossentropy(
               pred_logits=reward_logits,
@@ -350,7 +361,9 @@ class BMPC(struct.PyTreeNode):
       value_key, value_target_key = jax.random.split(value_key, 2)
 
       # TD targets
-      _, V_logits = self.model.V(latent_zs, value_params, key=value_key)
+      _, V_logits = self.model.V(
+          latent_zs, head_params['value'], key=value_key
+      )
       td_targets = self.td_target(z=encoder_zs, key=value_target_key)
       value_loss = jnp.sum(
           lam[:, None] * soft_crossentropy(
@@ -366,11 +379,8 @@ class BMPC(struct.PyTreeNode):
       # Continue loss
       ###########################################################
       if self.model.predict_continues:
-        continue_logits = self.model.continue_model.apply_fn(
-            {'params': continue_params}, latent_zs
-        ).squeeze(-1)
         continue_loss = optax.sigmoid_binary_cross_entropy(
-            continue_logits, 1 - terminated
+            continue_logits.squeeze(-1), 1 - terminated
         ).mean()
       else:
         continue_loss = 0.0
@@ -394,47 +404,27 @@ class BMPC(struct.PyTreeNode):
       }
 
     # Update world model
-    (encoder_grads, dynamics_grads, value_grads, reward_grads, continue_grads), info = jax.grad(
-        world_model_loss_fn, argnums=(0, 1, 2, 3, 4), has_aux=True)(
+    (encoder_grads, head_grads), info = jax.grad(
+        world_model_loss_fn, argnums=(0, 1), has_aux=True)(
             self.model.encoder.params,
-            self.model.dynamics_model.params,
-            self.model.value_model.params,
-            self.model.reward_model.params,
-            self.model.continue_model.params if self.model.predict_continues else None
+            self.model.heads.params,
     )
 
     new_encoder = self.model.encoder.apply_gradients(grads=encoder_grads)
-    new_dynamics_model = self.model.dynamics_model.apply_gradients(
-        grads=dynamics_grads
-    )
-    new_reward_model = self.model.reward_model.apply_gradients(
-        grads=reward_grads
-    )
-    new_value_model = self.model.value_model.apply_gradients(
-        grads=value_grads)
+    new_heads = self.model.heads.apply_gradients(grads=head_grads)
     new_target_value_model = self.model.target_value_model.replace(
         params=optax.incremental_update(
-            new_value_model.params,
+            new_heads.params['value'],
             self.model.target_value_model.params,
             self.tau
         )
     )
-    if self.model.predict_continues:
-      new_continue_model = self.model.continue_model.apply_gradients(
-          grads=continue_grads
-      )
-    else:
-      new_continue_model = self.model.continue_model
-
     # Update model
     new_agent = self.replace(
         model=self.model.replace(
             encoder=new_encoder,
-            dynamics_model=new_dynamics_model,
-            reward_model=new_reward_model,
-            value_model=new_value_model,
+            heads=new_heads,
             target_value_model=new_target_value_model,
-            continue_model=new_continue_model
         ),
     )
     return new_agent, info
@@ -453,17 +443,17 @@ class BMPC(struct.PyTreeNode):
           params=self.model.policy_model.params,
           key=action_keys[t]
       )[0]
-      reward, _ = self.model.reward(z, action, self.model.reward_model.params)
-      z = self.model.next(z, action, self.model.dynamics_model.params)
+      z, reward, _, continue_logits = self.model.step(
+          z=z,
+          a=action,
+          dynamics_params=self.model.heads.params['dynamics'],
+          reward_params=self.model.heads.params['reward'],
+      )
       G += discount * reward
       discount *= self.discount
 
       if self.model.predict_continues:
-        continues = jax.nn.sigmoid(
-            self.model.continue_model.apply_fn(
-                {'params': self.model.continue_model.params}, z
-            )
-        ).squeeze(-1) > 0.5
+        continues = jax.nn.sigmoid(continue_logits).squeeze(-1) > 0.5
         discount *= continues
 
     Vs, _ = self.model.V(
@@ -491,10 +481,14 @@ class BMPC(struct.PyTreeNode):
           key=key
       )
 
-      # Compute KL divergence between policy and expert
-      action_dist = tfd.MultivariateNormalDiag(mean, jnp.exp(log_std))
-      expert_dist = tfd.MultivariateNormalDiag(expert_mean, expert_std)
-      kl_div = tfd.kl_divergence(action_dist, expert_dist)
+      # Closed-form KL divergence between the diagonal-Gaussian policy
+      # and expert distributions
+      kl_div = jnp.sum(
+          jnp.log(expert_std) - log_std +
+          (jnp.exp(2*log_std) + (mean - expert_mean)**2) /
+          (2 * expert_std**2) - 0.5,
+          axis=-1
+      )
       kl_scale = percentile_normalization(
           kl_div[0], self.kl_scale
       ).clip(1, None)
@@ -5,7 +5,7 @@ import jax
 
 
 def mish(x: jax.Array) -> jax.Array:
-  return x * jnp.tanh(jnp.log(1 + jnp.exp(x)))
+  return x * jnp.tanh(jax.nn.softplus(x))
 
 
 def simnorm(x: jax.Array, simplex_dim: int = 8) -> jax.Array:
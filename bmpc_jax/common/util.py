@@ -45,15 +45,12 @@ def two_hot(x: jax.Array, low: float, high: float, num_bins: int) -> jax.Array:
 
 
 def two_hot_inv(x: jax.Array,
-                low: float, high: float, num_bins: int,
+                bin_centers: jax.Array,
                 apply_softmax: bool = True) -> jax.Array:
-
-  bins = jnp.linspace(low, high, num_bins)
-
   if apply_softmax:
     x = jax.nn.softmax(x, axis=-1)
 
-  x = jnp.sum(x * bins, axis=-1)
+  x = jnp.einsum('...b,b->...', x, bin_centers)
   return symexp(x)
 
 
@@ -2,6 +2,14 @@ import flax.linen as nn
 
 
 class Ensemble(nn.Module):
+  """
+  Vectorized ensemble of `num` copies of `base_module`.
+
+  Parameters are stacked along a leading `num` axis and the forward pass
+  is vmapped over that axis, so each Dense layer lowers to one batched
+  matmul across the whole ensemble rather than `num` separate GEMMs.
+  Inputs are broadcast to all members; outputs gain a leading `num` axis.
+  """
   base_module: nn.Module
   num: int = 2
 
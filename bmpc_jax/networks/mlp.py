@@ -33,3 +33,36 @@ class NormedLinear(nn.Module):
       x = nn.Dropout(rate=self.dropout_rate)(x, deterministic=not train)
 
     return x
+
+
+class SplitNormedLinear(nn.Module):
+  """
+  NormedLinear over the implicit concatenation of several inputs.
+
+  Each input gets its own Dense column and the columns are summed, which
+  is algebraically identical to a Dense over the concatenated inputs but
+  never materializes the concatenated array.
+  """
+  features: int
+  activation: Callable[[jax.Array], jax.Array] = None
+
+  kernel_init: Callable = nn.initializers.truncated_normal(stddev=0.02)
+  dtype: jnp.dtype = jnp.float32
+  param_dtype: jnp.dtype = jnp.float32
+
+  @nn.compact
+  def __call__(self, *inputs: jax.Array) -> jax.Array:
+    x = 0
+    for i, column in enumerate(inputs):
+      x += nn.Dense(features=self.features,
+                    use_bias=i == 0,
+                    kernel_init=self.kernel_init,
+                    bias_init=nn.initializers.zeros_init(),
+                    dtype=self.dtype,
+                    param_dtype=self.param_dtype)(column)
+
+    x = nn.LayerNorm(dtype=self.dtype)(x)
+    if self.activation is not None:
+      x = self.activation(x)
+
+    return x
@@ -135,7 +135,6 @@ def train(cfg: dict):
       apply_fn=encoder_module.apply,
       params=encoder_module.init(encoder_key, dummy_obs)['params'],
       tx=optax.chain(
-          optax.zero_nans(),
           optax.clip_by_global_norm(model_config.max_grad_norm),
           optax.adamw(encoder_config.learning_rate),
       )
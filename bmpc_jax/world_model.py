@@ -1,4 +1,3 @@
-import copy
 from functools import partial
 from typing import *
 import flax.linen as nn
@@ -8,26 +7,70 @@ import numpy as np
 import optax
 from flax import struct
 from flax.training.train_state import TrainState
+from jax.sharding import Mesh, NamedSharding, PartitionSpec
 from jaxtyping import PRNGKeyArray, PyTree
-from tensorflow_probability.substrates.jax import distributions as tfd
 
 from bmpc_jax.common.activations import mish, simnorm
 from bmpc_jax.common.util import symlog, two_hot_inv
-from bmpc_jax.networks import Ensemble, NormedLinear
+from bmpc_jax.networks import Ensemble, NormedLinear, SplitNormedLinear
 
 MIN_LOG_STD = -5
 MAX_LOG_STD = 1
 
+# Run residual fp32 matmuls (e.g., softmax reductions) on tensor cores
+jax.config.update('jax_default_matmul_precision', 'tensorfloat32')
+
+
+class RewardContinueModel(nn.Module):
+  """
+  Transition reward head with an optional continue head sharing its
+  two-layer trunk, so a rollout step pays for the trunk once.
+  """
+  latent_dim: int
+  num_bins: int
+  predict_continues: bool
+  dtype: jnp.dtype = jnp.float32
+
+  @nn.compact
+  def __call__(self, z: jax.Array, a: jax.Array
+               ) -> Tuple[jax.Array, Optional[jax.Array]]:
+    x = SplitNormedLinear(
+        self.latent_dim, activation=mish, dtype=self.dtype
+    )(z, a)
+    x = NormedLinear(self.latent_dim, activation=mish, dtype=self.dtype)(x)
+
+    reward_logits = nn.Dense(
+        self.num_bins,
+        kernel_init=nn.initializers.zeros,
+        dtype=self.dtype,
+        param_dtype=jnp.float32
+    )(x)
+    if self.predict_continues:
+      continue_logits = nn.Dense(
+          1,
+          kernel_init=nn.initializers.zeros,
+          dtype=self.dtype,
+          param_dtype=jnp.float32
+      )(x)
+    else:
+      continue_logits = None
+
+    return reward_logits, continue_logits
+
 
 class WorldModel(struct.PyTreeNode):
-  # Models
+  # Models. The dynamics/reward/value heads are updated together, so they
+  # share one TrainState (and one optimizer state) over a merged param
+  # tree; the policy keeps its own state since it updates on a different
+  # schedule, and the target is a gradient-free EMA copy.
   encoder: TrainState
-  dynamics_model: TrainState
-  reward_model: TrainState
+  heads: TrainState
   policy_model: TrainState
-  value_model: TrainState
   target_value_model: TrainState
-  continue_model: TrainState
+  # Apply fns for the merged heads (their params live in `heads`)
+  dynamics_apply: Callable = struct.field(pytree_node=False)
+  reward_apply: Callable = struct.field(pytree_node=False)
+  value_apply: Callable = struct.field(pytree_node=False)
   # Spaces
   action_dim: int = struct.field(pytree_node=False)
   # Architecture
@@ -35,8 +78,9 @@ class WorldModel(struct.PyTreeNode):
   simnorm_dim: int = struct.field(pytree_node=False)
   num_value_nets: int = struct.field(pytree_node=False)
   num_bins: int = struct.field(pytree_node=False)
-  symlog_min: float
-  symlog_max: float
+  symlog_min: float = struct.field(pytree_node=False)
+  symlog_max: float = struct.field(pytree_node=False)
+  bin_centers: jax.Array
   predict_continues: bool = struct.field(pytree_node=False)
 
   @classmethod
@@ -59,49 +103,35 @@ class WorldModel(struct.PyTreeNode):
              max_grad_norm: float = 20,
              # Misc
              tabulate: bool = False,
-             dtype: jnp.dtype = jnp.float32,
+             dtype: jnp.dtype = jnp.bfloat16,
              *,
              key: PRNGKeyArray,
              ):
     (
-        dynamics_key, reward_key, value_key, policy_key, continue_key
-    ) = jax.random.split(key, 5)
+        dynamics_key, reward_key, value_key, policy_key
+    ) = jax.random.split(key, 4)
 
     # Latent forward dynamics model
     dynamics_module = nn.Sequential([
-        NormedLinear(latent_dim, activation=mish, dtype=dtype),
+        SplitNormedLinear(latent_dim, activation=mish, dtype=dtype),
         NormedLinear(latent_dim, activation=mish, dtype=dtype),
         NormedLinear(latent_dim, activation=None, dtype=dtype),
     ])
-    dynamics_model = TrainState.create(
-        apply_fn=dynamics_module.apply,
-        params=dynamics_module.init(
-            dynamics_key, jnp.zeros(latent_dim + action_dim))['params'],
-        tx=optax.chain(
-            optax.zero_nans(),
-            optax.clip_by_global_norm(max_grad_norm),
-            optax.adamw(learning_rate),
-        )
-    )
+    dynamics_params = dynamics_module.init(
+        dynamics_key, jnp.zeros(latent_dim), jnp.zeros(action_dim)
+    )['params']
 
-    # Transition reward model
-    reward_module = nn.Sequential([
-        NormedLinear(latent_dim, activation=mish, dtype=dtype),
-        NormedLinear(latent_dim, activation=mish, dtype=dtype),
-        nn.Dense(
-            num_bins, kernel_init=nn.initializers.zeros, dtype=dtype
-        )
-    ])
-    reward_model = TrainState.create(
-        apply_fn=reward_module.apply,
-        params=reward_module.init(
-            reward_key, jnp.zeros(latent_dim + action_dim))['params'],
-        tx=optax.chain(
-            optax.zero_nans(),
-            optax.clip_by_global_norm(max_grad_norm),
-            optax.adamw(learning_rate),
-        )
+    # Transition reward model (with the continue head, if enabled,
+    # sharing its trunk)
+    reward_module = RewardContinueModel(
+        latent_dim=latent_dim,
+        num_bins=num_bins,
+        predict_continues=predict_continues,
+        dtype=dtype
     )
+    reward_params = reward_module.init(
+        reward_key, jnp.zeros(latent_dim), jnp.zeros(action_dim)
+    )['params']
 
     # Policy model
     policy_module = nn.Sequential([
@@ -110,14 +140,14 @@ class WorldModel(struct.PyTreeNode):
         nn.Dense(
             2*action_dim,
             kernel_init=nn.initializers.truncated_normal(0.02),
-            dtype=dtype
+            dtype=dtype,
+            param_dtype=jnp.float32
         )
     ])
     policy_model = TrainState.create(
         apply_fn=policy_module.apply,
         params=policy_module.init(policy_key, jnp.zeros(latent_dim))['params'],
         tx=optax.chain(
-            optax.zero_nans(),
             optax.clip_by_global_norm(max_grad_norm),
             optax.adamw(learning_rate),
         )
@@ -139,52 +169,43 @@ class WorldModel(struct.PyTreeNode):
             dtype=dtype
         ),
         nn.Dense(
-            num_bins, kernel_init=nn.initializers.zeros, dtype=dtype
+            num_bins,
+            kernel_init=nn.initializers.zeros,
+            dtype=dtype,
+            param_dtype=jnp.float32
         )
     ])
     value_ensemble = Ensemble(value_base, num=num_value_nets)
-    value_model = TrainState.create(
-        apply_fn=value_ensemble.apply,
-        params=value_ensemble.init(
-            {'params': value_param_key, 'dropout': value_dropout_key},
-            jnp.zeros(latent_dim))['params'],
+    value_params = value_ensemble.init(
+        {'params': value_param_key, 'dropout': value_dropout_key},
+        jnp.zeros(latent_dim))['params']
+
+    # One optimizer over the merged dynamics/reward/value tree
+    heads = TrainState.create(
+        apply_fn=None,
+        params={
+            'dynamics': dynamics_params,
+            'reward': reward_params,
+            'value': value_params,
+        },
         tx=optax.chain(
-            optax.zero_nans(),
             optax.clip_by_global_norm(max_grad_norm),
             optax.adamw(learning_rate),
         )
     )
     target_value_model = TrainState.create(
         apply_fn=value_ensemble.apply,
-        params=copy.deepcopy(value_model.params),
+        params=jax.tree.map(jnp.asarray, value_params),
         tx=optax.GradientTransformation(lambda _: None, lambda _: None))
 
-    if predict_continues:
-      continue_module = nn.Sequential([
-          NormedLinear(latent_dim, activation=mish, dtype=dtype),
-          NormedLinear(latent_dim, activation=mish, dtype=dtype),
-          nn.Dense(1, kernel_init=nn.initializers.zeros, dtype=dtype)
-      ])
-      continue_model = TrainState.create(
-          apply_fn=continue_module.apply,
-          params=continue_module.init(
-              continue_key, jnp.zeros(latent_dim))['params'],
-          tx=optax.chain(
-              optax.zero_nans(),
-              optax.clip_by_global_norm(max_grad_norm),
-              optax.adamw(learning_rate),
-          )
-      )
-    else:
-      continue_model = None
-
     if tabulate:
       print("Dynamics Model")
       print("--------------")
       print(
           dynamics_module.tabulate(
               jax.random.key(0),
-              jnp.ones(latent_dim + action_dim),
+              jnp.ones(latent_dim),
+              jnp.ones(action_dim),
               compute_flops=True
           )
       )
@@ -194,7 +215,8 @@ class WorldModel(struct.PyTreeNode):
       print(
           reward_module.tabulate(
               jax.random.key(0),
-              jnp.ones(latent_dim + action_dim),
+              jnp.ones(latent_dim),
+              jnp.ones(action_dim),
               compute_flops=True
           )
       )
@@ -217,26 +239,17 @@ class WorldModel(struct.PyTreeNode):
           )
       )
 
-      if predict_continues:
-        print("Continue Model")
-        print("--------------")
-        print(
-            continue_module.tabulate(
-                jax.random.key(0), jnp.ones(latent_dim), compute_flops=True
-            )
-        )
-
     return cls(
         # Spaces
         action_dim=action_dim,
         # Models
         encoder=encoder,
-        dynamics_model=dynamics_model,
-        reward_model=reward_model,
+        heads=heads,
         policy_model=policy_model,
-        value_model=value_model,
         target_value_model=target_value_model,
-        continue_model=continue_model,
+        dynamics_apply=dynamics_module.apply,
+        reward_apply=reward_module.apply,
+        value_apply=value_ensemble.apply,
         # Architecture
         latent_dim=latent_dim,
         simnorm_dim=simnorm_dim,
@@ -244,10 +257,15 @@ class WorldModel(struct.PyTreeNode):
         num_bins=num_bins,
         symlog_min=float(symlog_min),
         symlog_max=float(symlog_max),
+        # Symlog-space bin centers for two-hot decoding, computed once so
+        # reward/V reduce to a softmax and a single dot product
+        bin_centers=jnp.linspace(symlog_min, symlog_max, num_bins),
         predict_continues=predict_continues,
     )
 
-  @jax.jit
+  # Donate the rng keys: they are consumed exactly once per call. Params
+  # and latents are reused by callers, so they cannot be donated.
+  @partial(jax.jit, donate_argnames=('key',))
   def encode(self, obs: PyTree, params: Dict, key: PRNGKeyArray) -> jax.Array:
     z = self.encoder.apply_fn(
         {'params': params}, obs, rngs={'dropout': key}
@@ -256,22 +274,42 @@ class WorldModel(struct.PyTreeNode):
 
   @jax.jit
   def next(self, z: jax.Array, a: jax.Array, params: Dict) -> jax.Array:
-    z = self.dynamics_model.apply_fn(
-        {'params': params}, jnp.concatenate([z, a], axis=-1)
+    z = self.dynamics_apply(
+        {'params': params}, z, a
     ).astype(jnp.float32)
     return simnorm(z, simplex_dim=self.simnorm_dim)
 
   @jax.jit
   def reward(self, z: jax.Array, a: jax.Array, params: Dict
-             ) -> Tuple[jax.Array, jax.Array]:
-    z = jnp.concatenate([z, a], axis=-1)
-    logits = self.reward_model.apply_fn(
-        {'params': params}, z
+             ) -> Tuple[jax.Array, jax.Array, Optional[jax.Array]]:
+    reward_logits, continue_logits = self.reward_apply(
+        {'params': params}, z, a
+    )
+    reward_logits = reward_logits.astype(jnp.float32)
+    if self.predict_continues:
+      continue_logits = continue_logits.astype(jnp.float32)
+    reward = two_hot_inv(reward_logits, self.bin_centers)
+    return reward, reward_logits, continue_logits
+
+  @jax.jit
+  def step(self,
+           z: jax.Array,
+           a: jax.Array,
+           dynamics_params: Dict,
+           reward_params: Dict,
+           ) -> Tuple[jax.Array, jax.Array, jax.Array, Optional[jax.Array]]:
+    # Share the (z, a) input columns across the dynamics and reward heads
+    # so the whole transition lowers to a single fused HLO
+    next_z = self.dynamics_apply(
+        {'params': dynamics_params}, z, a
     ).astype(jnp.float32)
-    reward = two_hot_inv(
-        logits, self.symlog_min, self.symlog_max, self.num_bins
+    next_z = simnorm(next_z, simplex_dim=self.simnorm_dim)
+
+    reward, reward_logits, continue_logits = self.reward(
+        z, a, reward_params
     )
-    return reward, logits
+
+    return next_z, reward, reward_logits, continue_logits
 
   @jax.jit
   def sample_actions(self,
@@ -280,28 +318,65 @@ class WorldModel(struct.PyTreeNode):
                      *,
                      key: PRNGKeyArray
                      ) -> Tuple[jax.Array, ...]:
-    # Chunk the policy model output to get mean and logstd
-    mean, log_std = jnp.split(
-        self.policy_model.apply_fn({'params': params}, z).astype(jnp.float32), 2, axis=-1
-    )
+    # Slice the policy model output to get mean and logstd
+    policy_out = self.policy_model.apply_fn(
+        {'params': params}, z
+    ).astype(jnp.float32)
+    mean = policy_out[..., :self.action_dim]
+    log_std = policy_out[..., self.action_dim:]
     mean = jnp.tanh(mean)
-    log_std = MIN_LOG_STD + (MAX_LOG_STD - MIN_LOG_STD) * \
-        0.5 * (jnp.tanh(log_std) + 1)
+    log_std = jnp.clip(log_std, MIN_LOG_STD, MAX_LOG_STD)
     std = jnp.exp(log_std)
 
-    # Sample action and compute logprobs
-    dist = tfd.MultivariateNormalDiag(loc=mean, scale_diag=std)
-    action = dist.sample(seed=key)
-    log_probs = dist.log_prob(action)
+    # Reparameterized sample and analytical diagonal-Gaussian logprob
+    eps = jax.random.normal(key, mean.shape)
+    action = mean + std * eps
+    log_probs = -0.5 * jnp.sum(
+        eps**2 + 2*log_std + jnp.log(2*jnp.pi), axis=-1
+    )
 
     return action.clip(-1, 1), mean, log_std, log_probs
 
-  @jax.jit
+  @partial(jax.jit, donate_argnames=('key',))
   def V(self, z: jax.Array, params: Dict, key: PRNGKeyArray
         ) -> Tuple[jax.Array, jax.Array]:
-    logits = self.value_model.apply_fn(
+    logits = self.value_apply(
         {'params': params}, z, rngs={'dropout': key}
     ).astype(jnp.float32)
 
-    V = two_hot_inv(logits, self.symlog_min, self.symlog_max, self.num_bins)
+    V = two_hot_inv(logits, self.bin_centers)
     return V, logits
+
+  def shard_value_ensemble(self,
+                           devices: Optional[Sequence[Any]] = None
+                           ) -> 'WorldModel':
+    """
+    Shard the value ensemble across devices along its stacked member axis.
+
+    Places the leading `num_value_nets` axis of the value (and target
+    value) params on a 1D device mesh, so subsequent jitted calls to `V`
+    run each shard's members on its own device with the latent inputs
+    replicated. Uses all local devices by default; `num_value_nets` must
+    be divisible by the device count.
+    """
+    if devices is None:
+      devices = jax.local_devices()
+    if self.num_value_nets % len(devices) != 0:
+      raise ValueError(
+          f"num_value_nets ({self.num_value_nets}) must be divisible by "
+          f"the number of devices ({len(devices)})"
+      )
+
+    mesh = Mesh(np.array(devices), axis_names=('ensemble',))
+    member_sharding = NamedSharding(mesh, PartitionSpec('ensemble'))
+    shard = partial(jax.tree.map, lambda x: jax.device_put(x, member_sharding))
+
+    return self.replace(
+        heads=self.heads.replace(
+            params={**self.heads.params, 'value': shard(
+                self.heads.params['value'])}
+        ),
+        target_value_model=self.target_value_model.replace(
+            params=shard(self.target_value_model.params)
+        ),
+    )